@@ -2,19 +2,44 @@
 
 提供基于小牛翻译（Niutrans）API 的文本翻译服务，支持 450+ 种语言互译。
 """
+import itertools
+import logging
+import math
 import os
-from typing import Any, Dict, List, Tuple, Annotated
+import time
+import weakref
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Tuple, Annotated
 
+import anyio
 import requests
-from mcp.server.fastmcp import FastMCP
+from mcp.server.fastmcp import Context, FastMCP
 from mcp.types import Field
 
 __all__ = ["mcp", "main"]
 
+logger = logging.getLogger(__name__)
+
 # Create an MCP server
 mcp = FastMCP("Niutrans Translation")
 
 DEFAULT_NIUTRANS_API_URL = "https://api.niutrans.com/NiuTransServer/translation"
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_QUEUE_LIMIT = 100
+DEFAULT_CLIENT_QUEUE_LIMIT = 20
+DEFAULT_INTERACTIVE_CLIENT_LIMIT = 2
+
+# 优先级从高到低排列；交互式请求总是先于批量请求获得上游并发槽位。
+PRIORITY_CLASSES: Tuple[str, ...] = ("interactive", "batch", "bulk")
+DEFAULT_PRIORITY = "interactive"
+DEFAULT_QUEUE_TIMEOUTS: Dict[str, float] = {
+    "interactive": 5.0,
+    "batch": 30.0,
+    "bulk": 60.0,
+}
+ANONYMOUS_CLIENT = "anonymous"
 
 
 LANGUAGE_ENTRIES: List[Tuple[str, str, str]] = [
@@ -530,6 +555,345 @@ def _call_niutrans(payload: Dict[str, Any]) -> Dict[str, Any]:
     return data
 
 
+class _Waiter:
+    __slots__ = ("client_id", "enqueued_at", "granted", "evicted", "event")
+
+    def __init__(self, client_id: str) -> None:
+        self.client_id = client_id
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.evicted = False
+        self.event = anyio.Event()
+
+
+@dataclass
+class _ClassStats:
+    admitted: int = 0
+    rejected: int = 0
+    shed: int = 0
+    evicted: int = 0
+    demoted: int = 0
+    wait_total: float = 0.0
+    wait_max: float = 0.0
+
+
+class UpstreamScheduler:
+    """按优先级和客户端公平调度对小牛翻译接口的并发调用。
+
+    高优先级类别的排队请求总是先被放行；同一类别内优先放行在途请求最少的客户端，
+    并列时按客户端轮询，避免单个客户端的大批量任务占满全部并发槽位。
+
+    队列有两级上限：每个客户端在每个类别内的排队数，以及每个类别的总排队数。
+    类别已满时，会从排队最多的客户端挤出其最新的请求，而不是拒绝新来的客户端。
+    单个客户端在 interactive 类别中排队加在途的请求达到上限后，其后续请求会被降级到 batch，
+    因此即使调用方不主动声明 bulk，也无法独占交互式通道。
+    排队超过该类别的截止时间后请求会被丢弃（load shedding）。
+
+    调度器只在事件循环线程内使用，状态变更之间没有 await，因此无需额外加锁。
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        queue_limit: int = DEFAULT_QUEUE_LIMIT,
+        queue_timeouts: Optional[Dict[str, float]] = None,
+        client_queue_limit: int = DEFAULT_CLIENT_QUEUE_LIMIT,
+        interactive_client_limit: int = DEFAULT_INTERACTIVE_CLIENT_LIMIT,
+    ) -> None:
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency 必须大于 0")
+        if queue_limit < 0:
+            raise ValueError("queue_limit 不能为负数")
+        if client_queue_limit < 1:
+            raise ValueError("client_queue_limit 必须大于 0")
+        if interactive_client_limit < 1:
+            raise ValueError("interactive_client_limit 必须大于 0")
+
+        self.max_concurrency = max_concurrency
+        self.queue_limit = queue_limit
+        self.client_queue_limit = client_queue_limit
+        self.interactive_client_limit = interactive_client_limit
+        self.queue_timeouts = dict(DEFAULT_QUEUE_TIMEOUTS)
+        if queue_timeouts:
+            self.queue_timeouts.update(queue_timeouts)
+
+        self._active = 0
+        self._queues: Dict[str, "OrderedDict[str, Deque[_Waiter]]"] = {
+            priority: OrderedDict() for priority in PRIORITY_CLASSES
+        }
+        self._depth: Dict[str, int] = {priority: 0 for priority in PRIORITY_CLASSES}
+        self._inflight: Dict[str, Dict[str, int]] = {
+            priority: {} for priority in PRIORITY_CLASSES
+        }
+        self._stats: Dict[str, _ClassStats] = {
+            priority: _ClassStats() for priority in PRIORITY_CLASSES
+        }
+
+    @asynccontextmanager
+    async def slot(self, priority: str, client_id: str) -> AsyncIterator[str]:
+        """占用一个上游并发槽位，退出时自动释放；产出实际使用的优先级。"""
+        granted_priority = await self.acquire(priority, client_id)
+        try:
+            yield granted_priority
+        finally:
+            self.release(granted_priority, client_id)
+
+    async def acquire(self, priority: str, client_id: str) -> str:
+        """排队等待上游并发槽位，返回实际放行的优先级（可能因降级而不同于请求值）。"""
+        if (
+            priority == "interactive"
+            and self._load(priority, client_id) >= self.interactive_client_limit
+        ):
+            self._stats[priority].demoted += 1
+            priority = "batch"
+
+        if self._active >= self.max_concurrency:
+            queued = len(self._queues[priority].get(client_id, ()))
+            if queued >= self.client_queue_limit:
+                self._stats[priority].rejected += 1
+                raise RuntimeError(
+                    f"当前客户端排队的翻译请求过多（{priority}），请稍后重试"
+                )
+            if self._depth[priority] >= self.queue_limit and not self._evict(
+                priority, client_id
+            ):
+                self._stats[priority].rejected += 1
+                raise RuntimeError(f"翻译请求队列已满（{priority}），请稍后重试")
+
+        waiter = _Waiter(client_id)
+        self._queues[priority].setdefault(client_id, deque()).append(waiter)
+        self._depth[priority] += 1
+        self._dispatch()
+
+        try:
+            with anyio.move_on_after(self.queue_timeouts[priority]):
+                await waiter.event.wait()
+        except BaseException:
+            # 调用方被取消：已拿到的槽位要归还，仍在排队的要出队。
+            if waiter.granted:
+                self.release(priority, client_id)
+            else:
+                self._remove(priority, waiter)
+            raise
+
+        if waiter.granted:
+            return priority
+        if waiter.evicted:
+            raise RuntimeError(
+                f"翻译请求队列已满（{priority}），当前客户端排队过多，请求已被移出队列"
+            )
+
+        self._remove(priority, waiter)
+        self._stats[priority].shed += 1
+        raise RuntimeError(
+            f"翻译请求排队超过 {self.queue_timeouts[priority]:g} 秒（{priority}），已被丢弃"
+        )
+
+    def release(self, priority: str, client_id: str) -> None:
+        self._active -= 1
+        inflight = self._inflight[priority]
+        inflight[client_id] -= 1
+        if not inflight[client_id]:
+            del inflight[client_id]
+        self._dispatch()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """返回当前各优先级的队列深度与等待时间统计。"""
+        classes: Dict[str, Any] = {}
+        now = time.monotonic()
+        for priority in PRIORITY_CLASSES:
+            stats = self._stats[priority]
+            oldest = min(
+                (waiters[0].enqueued_at for waiters in self._queues[priority].values()),
+                default=None,
+            )
+            classes[priority] = {
+                "queue_depth": self._depth[priority],
+                "queued_clients": len(self._queues[priority]),
+                "in_flight": sum(self._inflight[priority].values()),
+                "queue_timeout_seconds": self.queue_timeouts[priority],
+                "admitted": stats.admitted,
+                "rejected": stats.rejected,
+                "shed": stats.shed,
+                "evicted": stats.evicted,
+                "demoted": stats.demoted,
+                "avg_wait_seconds": stats.wait_total / stats.admitted if stats.admitted else 0.0,
+                "max_wait_seconds": stats.wait_max,
+                "oldest_wait_seconds": now - oldest if oldest is not None else 0.0,
+            }
+        return {
+            "max_concurrency": self.max_concurrency,
+            "queue_limit": self.queue_limit,
+            "client_queue_limit": self.client_queue_limit,
+            "interactive_client_limit": self.interactive_client_limit,
+            "active": self._active,
+            "classes": classes,
+        }
+
+    def _load(self, priority: str, client_id: str) -> int:
+        queued = len(self._queues[priority].get(client_id, ()))
+        return queued + self._inflight[priority].get(client_id, 0)
+
+    def _dispatch(self) -> None:
+        while self._active < self.max_concurrency:
+            picked = self._next_waiter()
+            if picked is None:
+                break
+            priority, waiter = picked
+            waiter.granted = True
+            waiter.event.set()
+            self._active += 1
+            inflight = self._inflight[priority]
+            inflight[waiter.client_id] = inflight.get(waiter.client_id, 0) + 1
+
+    def _next_waiter(self) -> Optional[Tuple[str, _Waiter]]:
+        for priority in PRIORITY_CLASSES:
+            clients = self._queues[priority]
+            if not clients:
+                continue
+            # 优先放行在途请求最少的客户端；并列时取队首客户端，放行后把它移到队尾（轮询）。
+            inflight = self._inflight[priority]
+            client_id = min(clients, key=lambda client: inflight.get(client, 0))
+            waiters = clients[client_id]
+            waiter = waiters.popleft()
+            if waiters:
+                clients.move_to_end(client_id)
+            else:
+                del clients[client_id]
+            self._depth[priority] -= 1
+
+            stats = self._stats[priority]
+            waited = time.monotonic() - waiter.enqueued_at
+            stats.admitted += 1
+            stats.wait_total += waited
+            stats.wait_max = max(stats.wait_max, waited)
+            return priority, waiter
+        return None
+
+    def _evict(self, priority: str, client_id: str) -> bool:
+        """类别已满时，从排队最多的其他客户端挤出其最新的请求，为 client_id 腾出位置。"""
+        clients = self._queues[priority]
+        own = len(clients.get(client_id, ()))
+        victim_id = max(
+            (client for client in clients if client != client_id),
+            key=lambda client: len(clients[client]),
+            default=None,
+        )
+        # 只有挤出后双方排队数不会倒挂时才挤出，否则拒绝新请求。
+        if victim_id is None or len(clients[victim_id]) <= own + 1:
+            return False
+
+        victims = clients[victim_id]
+        victim = victims.pop()
+        if not victims:
+            del clients[victim_id]
+        self._depth[priority] -= 1
+        self._stats[priority].evicted += 1
+        victim.evicted = True
+        victim.event.set()
+        return True
+
+    def _remove(self, priority: str, waiter: _Waiter) -> None:
+        clients = self._queues[priority]
+        waiters = clients.get(waiter.client_id)
+        if waiters is None or waiter not in waiters:
+            return
+        waiters.remove(waiter)
+        if not waiters:
+            del clients[waiter.client_id]
+        self._depth[priority] -= 1
+
+
+def _env_int(name: str, default: int, minimum: int) -> int:
+    value = os.getenv(name)
+    if not value:
+        return default
+    try:
+        parsed = int(value)
+    except ValueError:
+        parsed = None
+    if parsed is None or parsed < minimum:
+        logger.warning("环境变量 %s=%r 无效（需为不小于 %d 的整数），使用默认值 %d", name, value, minimum, default)
+        return default
+    return parsed
+
+
+def _env_seconds(name: str, default: float) -> float:
+    value = os.getenv(name)
+    if not value:
+        return default
+    try:
+        parsed = float(value)
+    except ValueError:
+        parsed = math.nan
+    if not math.isfinite(parsed) or parsed <= 0:
+        logger.warning("环境变量 %s=%r 无效（需为正数秒数），使用默认值 %g", name, value, default)
+        return default
+    return parsed
+
+
+def _build_scheduler() -> UpstreamScheduler:
+    timeouts = {
+        priority: _env_seconds(f"NIUTRANS_QUEUE_TIMEOUT_{priority.upper()}", seconds)
+        for priority, seconds in DEFAULT_QUEUE_TIMEOUTS.items()
+    }
+    return UpstreamScheduler(
+        max_concurrency=_env_int("NIUTRANS_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY, 1),
+        queue_limit=_env_int("NIUTRANS_QUEUE_LIMIT", DEFAULT_QUEUE_LIMIT, 0),
+        queue_timeouts=timeouts,
+        client_queue_limit=_env_int(
+            "NIUTRANS_CLIENT_QUEUE_LIMIT", DEFAULT_CLIENT_QUEUE_LIMIT, 1
+        ),
+        interactive_client_limit=_env_int(
+            "NIUTRANS_INTERACTIVE_CLIENT_LIMIT", DEFAULT_INTERACTIVE_CLIENT_LIMIT, 1
+        ),
+    )
+
+
+_scheduler: Optional[UpstreamScheduler] = None
+
+
+def _get_scheduler() -> UpstreamScheduler:
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = _build_scheduler()
+    return _scheduler
+
+
+def _ensure_priority(value: str) -> str:
+    priority = (value or DEFAULT_PRIORITY).strip().lower()
+    if priority not in PRIORITY_CLASSES:
+        raise RuntimeError(
+            f"不支持的优先级: {value}。可选值: {', '.join(PRIORITY_CLASSES)}"
+        )
+    return priority
+
+
+_session_keys: "weakref.WeakKeyDictionary[Any, str]" = weakref.WeakKeyDictionary()
+_session_counter = itertools.count(1)
+
+
+def _session_key(session: Any) -> str:
+    key = _session_keys.get(session)
+    if key is None:
+        key = f"session-{next(_session_counter)}"
+        _session_keys[session] = key
+    return key
+
+
+def _resolve_client_id(ctx: Optional[Context], fallback: Optional[str]) -> str:
+    """按 MCP 会话做公平调度；不在会话内调用时才退回调用方传入的 client_id。"""
+    if ctx is not None:
+        try:
+            session = ctx.session
+        except ValueError:
+            # 不在请求上下文中（例如直接调用工具函数）。
+            session = None
+        if session is not None:
+            return _session_key(session)
+    return fallback or ANONYMOUS_CLIENT
+
+
 def _ensure_language_code(label: str, value: str) -> str:
     if not value:
         raise RuntimeError(f"缺少 {label} 语言代码")
@@ -560,19 +924,30 @@ def _ensure_language_code(label: str, value: str) -> str:
 
 
 @mcp.tool()
-def translate_text(
+async def translate_text(
     text: Annotated[str, Field(description="待翻译的原文文本，可以是任意长度的字符串。")],
     source: Annotated[str, Field(description='源语言代码或常见别名（例如 "zh"、"中文"、"chinese"）。')],
     target: Annotated[str, Field(description='目标语言代码或常见别名（例如 "en"、"英文"、"english"）。')],
+    priority: Annotated[str, Field(description='调度优先级："interactive"（默认）、"batch" 或 "bulk"。批量或后台任务请显式传入 "bulk" 或 "batch"；同一会话过多的 interactive 请求会被自动降级为 batch。')] = DEFAULT_PRIORITY,
+    client_id: Annotated[Optional[str], Field(description="调用方标识，仅在不处于 MCP 会话中（例如直接调用本函数）时用于公平调度。")] = None,
+    ctx: Optional[Context] = None,
 ) -> Dict[str, Any]:
     """使用小牛翻译 API 将文本从 source 语种翻译到 target 语种。
 
     支持 450+ 种语言代码，并可自动处理常见别名。返回结构包含译文和 API 原始响应。
 
+    上游调用经过优先级调度：未指定 priority 时按 interactive 处理，
+    批量翻译任务应显式传入 priority="bulk"（或 "batch"）；即使未声明，
+    同一会话在 interactive 类别中排队加在途的请求超过上限后也会被降级为 batch。
+    同一优先级内按 MCP 会话公平分配并发。
+
     Args:
         text (str): 待翻译的原文文本，可以是任意长度的字符串。
         source (str): 源语言代码或常见别名（例如 "zh"、"中文"、"chinese"）。
         target (str): 目标语言代码或常见别名（例如 "en"、"英文"、"english"）。
+        priority (str): 调度优先级，interactive 高于 batch 高于 bulk，默认 interactive。
+        client_id (Optional[str]): 调用方标识，仅在不处于 MCP 会话中时使用。
+        ctx (Optional[Context]): FastMCP 注入的请求上下文，用于识别调用会话。
 
     Returns:
         Dict[str, Any]: 包含以下字段的字典：
@@ -588,6 +963,7 @@ def translate_text(
 
     source_code = _ensure_language_code("source", source)
     target_code = _ensure_language_code("target", target)
+    priority_class = _ensure_priority(priority)
 
     payload: Dict[str, Any] = {
         "apikey": api_key,
@@ -596,7 +972,9 @@ def translate_text(
         "src_text": text,
     }
 
-    data = _call_niutrans(payload)
+    scheduler = _get_scheduler()
+    async with scheduler.slot(priority_class, _resolve_client_id(ctx, client_id)):
+        data = await anyio.to_thread.run_sync(_call_niutrans, payload)
 
     translated = data.get("tgt_text") or data.get("target_text")
     if translated is None:
@@ -630,6 +1008,16 @@ def language_catalog() -> Dict[str, Any]:
     }
 
 
+@mcp.resource("scheduler://stats")
+def scheduler_stats() -> Dict[str, Any]:
+    """提供上游调用调度器的实时状态。
+
+    返回各优先级的队列深度、排队客户端数、在途请求数、放行/拒绝/丢弃/挤出/降级次数以及平均和最大等待时间。
+    """
+
+    return _get_scheduler().snapshot()
+
+
 def main():
     """Main entry point for the translation server."""
     mcp.run()
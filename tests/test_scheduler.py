@@ -0,0 +1,262 @@
+import math
+
+import anyio
+import pytest
+from anyio import wait_all_tasks_blocked
+from anyio.lowlevel import checkpoint
+
+import translation_server
+from translation_server import UpstreamScheduler
+
+pytestmark = pytest.mark.anyio
+
+
+async def _run_in_order(scheduler, order, requests):
+    """Queue requests one by one behind a held slot, then release it."""
+    async def worker(priority, client_id, tag):
+        async with scheduler.slot(priority, client_id):
+            order.append(tag)
+            await checkpoint()
+
+    await scheduler.acquire("interactive", "holder")
+    async with anyio.create_task_group() as tg:
+        for priority, client_id, tag in requests:
+            tg.start_soon(worker, priority, client_id, tag)
+            await wait_all_tasks_blocked()
+        scheduler.release("interactive", "holder")
+
+
+async def test_higher_class_admitted_first():
+    scheduler = UpstreamScheduler(max_concurrency=1)
+    order = []
+    await _run_in_order(
+        scheduler,
+        order,
+        [("bulk", "a", "bulk"), ("batch", "b", "batch"), ("interactive", "c", "interactive")],
+    )
+    assert order == ["interactive", "batch", "bulk"]
+
+
+async def test_clients_round_robin_within_class():
+    scheduler = UpstreamScheduler(max_concurrency=1)
+    order = []
+    await _run_in_order(
+        scheduler,
+        order,
+        [("bulk", "a", "a1"), ("bulk", "a", "a2"), ("bulk", "a", "a3"), ("bulk", "b", "b1")],
+    )
+    assert order == ["a1", "b1", "a2", "a3"]
+
+
+async def test_rejects_when_queue_full():
+    scheduler = UpstreamScheduler(max_concurrency=1, queue_limit=1)
+    await scheduler.acquire("bulk", "holder")
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(scheduler.acquire, "bulk", "a")
+        await wait_all_tasks_blocked()
+
+        with pytest.raises(RuntimeError, match="队列已满"):
+            await scheduler.acquire("bulk", "b")
+
+        # 其他类别的队列不受影响
+        tg.start_soon(scheduler.acquire, "interactive", "c")
+        await wait_all_tasks_blocked()
+        assert scheduler.snapshot()["classes"]["interactive"]["queue_depth"] == 1
+        tg.cancel_scope.cancel()
+
+    assert scheduler.snapshot()["classes"]["bulk"]["rejected"] == 1
+
+
+async def test_sheds_after_deadline_and_cleans_up():
+    scheduler = UpstreamScheduler(max_concurrency=1, queue_timeouts={"interactive": 0.05})
+    await scheduler.acquire("bulk", "holder")
+
+    with pytest.raises(RuntimeError, match="已被丢弃"):
+        await scheduler.acquire("interactive", "a")
+
+    stats = scheduler.snapshot()["classes"]["interactive"]
+    assert stats["shed"] == 1
+    assert stats["queue_depth"] == 0
+    assert stats["queued_clients"] == 0
+    assert stats["admitted"] == 0
+
+    scheduler.release("bulk", "holder")
+    assert scheduler.snapshot()["active"] == 0
+
+
+async def test_cancelled_waiter_leaves_queue():
+    scheduler = UpstreamScheduler(max_concurrency=1)
+    await scheduler.acquire("bulk", "holder")
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(scheduler.acquire, "bulk", "a")
+        await wait_all_tasks_blocked()
+        tg.cancel_scope.cancel()
+
+    stats = scheduler.snapshot()["classes"]["bulk"]
+    assert stats["queue_depth"] == 0
+    assert stats["queued_clients"] == 0
+
+
+async def test_snapshot_values():
+    scheduler = UpstreamScheduler(max_concurrency=1, queue_limit=5)
+    await scheduler.acquire("interactive", "holder")
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(scheduler.acquire, "bulk", "a")
+        tg.start_soon(scheduler.acquire, "bulk", "b")
+        await wait_all_tasks_blocked()
+
+        snapshot = scheduler.snapshot()
+        assert snapshot["max_concurrency"] == 1
+        assert snapshot["queue_limit"] == 5
+        assert snapshot["active"] == 1
+        bulk = snapshot["classes"]["bulk"]
+        assert bulk["queue_depth"] == 2
+        assert bulk["queued_clients"] == 2
+        assert bulk["admitted"] == 0
+        assert bulk["in_flight"] == 0
+        assert bulk["oldest_wait_seconds"] >= 0
+        assert snapshot["classes"]["interactive"]["in_flight"] == 1
+        tg.cancel_scope.cancel()
+
+    interactive = scheduler.snapshot()["classes"]["interactive"]
+    assert interactive["admitted"] == 1
+    assert isinstance(interactive["admitted"], int)
+    assert interactive["rejected"] == 0
+    assert interactive["shed"] == 0
+    assert interactive["evicted"] == 0
+    assert interactive["demoted"] == 0
+    assert interactive["max_wait_seconds"] >= interactive["avg_wait_seconds"] >= 0
+
+
+async def test_full_class_evicts_from_longest_client():
+    scheduler = UpstreamScheduler(max_concurrency=2, queue_limit=3)
+    await scheduler.acquire("bulk", "a")
+    await scheduler.acquire("bulk", "a")
+    results = {}
+
+    async def waiter(client_id, tag):
+        try:
+            async with scheduler.slot("bulk", client_id):
+                results[tag] = "served"
+                await anyio.sleep_forever()
+        except RuntimeError:
+            results[tag] = "evicted"
+
+    async with anyio.create_task_group() as tg:
+        for tag in ("a1", "a2", "a3"):
+            tg.start_soon(waiter, "a", tag)
+            await wait_all_tasks_blocked()
+        tg.start_soon(waiter, "b", "b1")
+        await wait_all_tasks_blocked()
+
+        assert results == {"a3": "evicted"}
+        stats = scheduler.snapshot()["classes"]["bulk"]
+        assert stats["queue_depth"] == 3
+        assert stats["evicted"] == 1
+        assert stats["rejected"] == 0
+
+        # b 没有在途请求，释放槽位后先于 a 的排队请求被放行
+        scheduler.release("bulk", "a")
+        await wait_all_tasks_blocked()
+        assert results == {"a3": "evicted", "b1": "served"}
+        tg.cancel_scope.cancel()
+
+
+async def test_rejects_client_over_its_queue_limit():
+    scheduler = UpstreamScheduler(max_concurrency=1, client_queue_limit=2)
+    await scheduler.acquire("bulk", "holder")
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(scheduler.acquire, "bulk", "a")
+        tg.start_soon(scheduler.acquire, "bulk", "a")
+        await wait_all_tasks_blocked()
+
+        with pytest.raises(RuntimeError, match="排队的翻译请求过多"):
+            await scheduler.acquire("bulk", "a")
+
+        # 其他客户端仍可排队
+        tg.start_soon(scheduler.acquire, "bulk", "b")
+        await wait_all_tasks_blocked()
+        assert scheduler.snapshot()["classes"]["bulk"]["queue_depth"] == 3
+        tg.cancel_scope.cancel()
+
+
+async def test_heavy_interactive_client_is_demoted():
+    scheduler = UpstreamScheduler(max_concurrency=2, interactive_client_limit=2)
+    assert await scheduler.acquire("interactive", "a") == "interactive"
+    assert await scheduler.acquire("interactive", "a") == "interactive"
+    order = []
+
+    async def worker(client_id, tag):
+        async with scheduler.slot("interactive", client_id) as granted:
+            order.append((tag, granted))
+
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(worker, "a", "a3")
+        await wait_all_tasks_blocked()
+        tg.start_soon(worker, "b", "b1")
+        await wait_all_tasks_blocked()
+
+        snapshot = scheduler.snapshot()["classes"]
+        assert snapshot["interactive"]["demoted"] == 1
+        assert snapshot["batch"]["queue_depth"] == 1
+        assert snapshot["interactive"]["queue_depth"] == 1
+
+        scheduler.release("interactive", "a")
+        scheduler.release("interactive", "a")
+
+    assert order == [("b1", "interactive"), ("a3", "batch")]
+
+
+async def test_cancel_after_grant_returns_slot():
+    scheduler = UpstreamScheduler(max_concurrency=1)
+    await scheduler.acquire("bulk", "holder")
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(scheduler.acquire, "bulk", "a")
+        await wait_all_tasks_blocked()
+        # 取消已投递、等待者尚未恢复运行时被放行
+        tg.cancel_scope.cancel()
+        scheduler.release("bulk", "holder")
+        assert scheduler.snapshot()["active"] == 1
+
+    snapshot = scheduler.snapshot()
+    assert snapshot["active"] == 0
+    assert snapshot["classes"]["bulk"]["in_flight"] == 0
+    with anyio.fail_after(1):
+        await scheduler.acquire("interactive", "b")
+
+
+async def test_slot_released_after_exception():
+    scheduler = UpstreamScheduler(max_concurrency=1)
+    with pytest.raises(ValueError):
+        async with scheduler.slot("interactive", "a"):
+            raise ValueError("boom")
+
+    assert scheduler.snapshot()["active"] == 0
+    with anyio.fail_after(1):
+        async with scheduler.slot("bulk", "b"):
+            assert scheduler.snapshot()["active"] == 1
+
+
+@pytest.mark.parametrize("value", ["abc", "0", "2.5", "-1"])
+def test_invalid_concurrency_falls_back_to_default(monkeypatch, value):
+    monkeypatch.setenv("NIUTRANS_MAX_CONCURRENCY", value)
+    scheduler = translation_server._build_scheduler()
+    assert scheduler.max_concurrency == translation_server.DEFAULT_MAX_CONCURRENCY
+
+
+@pytest.mark.parametrize("value", ["abc", "0", "-3", "nan", "inf"])
+def test_invalid_timeout_falls_back_to_default(monkeypatch, value):
+    monkeypatch.setenv("NIUTRANS_QUEUE_TIMEOUT_BULK", value)
+    scheduler = translation_server._build_scheduler()
+    assert scheduler.queue_timeouts["bulk"] == translation_server.DEFAULT_QUEUE_TIMEOUTS["bulk"]
+    assert math.isfinite(scheduler.queue_timeouts["bulk"])
+
+
+def test_env_settings_are_parsed(monkeypatch):
+    monkeypatch.setenv("NIUTRANS_MAX_CONCURRENCY", "8")
+    monkeypatch.setenv("NIUTRANS_QUEUE_LIMIT", "0")
+    monkeypatch.setenv("NIUTRANS_QUEUE_TIMEOUT_INTERACTIVE", "1.5")
+    scheduler = translation_server._build_scheduler()
+    assert scheduler.max_concurrency == 8
+    assert scheduler.queue_limit == 0
+    assert scheduler.queue_timeouts["interactive"] == 1.5
@@ -0,0 +1,81 @@
+import threading
+
+import pytest
+
+import translation_server
+from translation_server import ANONYMOUS_CLIENT, UpstreamScheduler
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    scheduler = UpstreamScheduler()
+    monkeypatch.setattr(translation_server, "_scheduler", scheduler)
+    monkeypatch.setenv("NIUTRANS_API_KEY", "test-key")
+    return scheduler
+
+
+@pytest.fixture
+def calls(monkeypatch, scheduler):
+    calls = []
+
+    def fake_call_niutrans(payload):
+        calls.append(
+            {
+                "payload": payload,
+                "thread": threading.get_ident(),
+                "in_flight": {
+                    priority: dict(clients)
+                    for priority, clients in scheduler._inflight.items()
+                    if clients
+                },
+            }
+        )
+        return {"tgt_text": f"translated:{payload['src_text']}"}
+
+    monkeypatch.setattr(translation_server, "_call_niutrans", fake_call_niutrans)
+    return calls
+
+
+async def test_rejects_invalid_priority(calls):
+    with pytest.raises(RuntimeError, match="不支持的优先级"):
+        await translation_server.translate_text("你好", "zh", "en", priority="urgent")
+    assert calls == []
+
+
+async def test_upstream_call_runs_off_event_loop_thread(calls, scheduler):
+    result = await translation_server.translate_text("你好", "中文", "english")
+
+    assert result["translated_text"] == "translated:你好"
+    assert result["source"] == "zh"
+    assert result["target"] == "en"
+    assert calls[0]["thread"] != threading.get_ident()
+    assert scheduler.snapshot()["active"] == 0
+
+
+async def test_without_context_uses_client_id(calls):
+    await translation_server.translate_text(
+        "你好", "zh", "en", priority="Bulk", client_id="agent-1"
+    )
+    await translation_server.translate_text("你好", "zh", "en")
+
+    assert calls[0]["in_flight"] == {"bulk": {"agent-1": 1}}
+    assert calls[1]["in_flight"] == {"interactive": {ANONYMOUS_CLIENT: 1}}
+
+
+class _FakeContext:
+    def __init__(self, session):
+        self.session = session
+
+
+class _FakeSession:
+    pass
+
+
+def test_session_keys_are_stable_and_distinct():
+    first, second = _FakeSession(), _FakeSession()
+
+    first_key = translation_server._resolve_client_id(_FakeContext(first), "ignored")
+    assert translation_server._resolve_client_id(_FakeContext(first), None) == first_key
+    assert translation_server._resolve_client_id(_FakeContext(second), None) != first_key